@@ -19,41 +19,61 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
+import collections
 import errno
+import functools
+import http.client
 import io
 import logging
-import select
+import selectors
 import socket
 import struct
-import sys
+import threading
 import time
 
 import kdcproxy.codec as codec
 from kdcproxy.config import MetaResolver
 
-if sys.version_info.major >= 3:  # Python 3.x
-    import http.client as httplib
-    import urllib.parse as urlparse
-else:
-    import httplib
-    import urlparse
-
 logging.basicConfig()
 logger = logging.getLogger('kdcproxy')
 
+ADDR_FAMILIES = frozenset((socket.AF_INET, socket.AF_INET6))
+ADDR_SOCKTYPES = frozenset((socket.SOCK_STREAM, socket.SOCK_DGRAM))
+ADDR_PROTOCOLS = frozenset((socket.IPPROTO_TCP, socket.IPPROTO_UDP))
+SOCK_NONBLOCK = getattr(socket, "SOCK_NONBLOCK", 0)
+UINT32 = struct.Struct("!I")
+UNREACHABLE_ERRNOS = frozenset((errno.EHOSTUNREACH, errno.ENETUNREACH))
+
+KDCURL = collections.namedtuple("KDCURL", ("scheme", "hostname", "port"))
 
-class HTTPException(Exception):
 
-    def __init__(self, code, msg, headers=[]):
-        headers = list(filter(lambda h: h[0] != 'Content-Length', headers))
+@functools.lru_cache(maxsize=256)
+def parse_kdc_url(url):
+    # Servers always look like "scheme://host[:port]", where host may be a
+    # bracketed IPv6 address, so there is no need for the general urlparse().
+    scheme, _, hostport = url.partition("://")
+    hostport = hostport.split("/", 1)[0]
+    if hostport.startswith("["):
+        hostname, _, port = hostport[1:].partition("]")
+        port = port[1:]
+    else:
+        hostname, _, port = hostport.partition(":")
+    port = int(port) if port.isdigit() else None
+    return KDCURL(scheme, hostname.lower() or None, port)
+
+
+class HTTPException(Exception):
 
-        if 'Content-Type' not in dict(headers):
-            headers.append(('Content-Type', 'text/plain; charset=utf-8'))
+    def __init__(self, code, msg, headers=()):
+        headers = {k: v for (k, v) in headers if k != 'Content-Length'}
+        headers.setdefault('Content-Type', 'text/plain; charset=utf-8')
 
-        if sys.version_info.major == 3 and isinstance(msg, str):
-            msg = bytes(msg, "utf-8")
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
 
-        headers.append(('Content-Length', str(len(msg))))
+        headers['Content-Length'] = str(len(msg))
+        headers = list(headers.items())
 
         super(HTTPException, self).__init__(code, msg, headers)
         self.code = code
@@ -61,96 +81,138 @@ class HTTPException(Exception):
         self.headers = headers
 
     def __str__(self):
-        return "%d %s" % (self.code, httplib.responses[self.code])
+        return "%d %s" % (self.code, http.client.responses[self.code])
 
 
 class SocketException(Exception):
 
-    def __init__(self, message, sock):
+    def __init__(self, message, sock, partial=False):
         super(Exception, self).__init__(message)
         self.sockfno = sock.fileno()
+        # Whether part of a reply had arrived over sock.
+        self.partial = partial
 
 
 class Application:
     MAX_LENGTH = 128 * 1024
+    MAX_REPLY_LENGTH = 1024 * 1024
+    ADDRINFO_TTL = 60
+    ADDRINFO_CACHE_SIZE = 256
+    LOOKUP_TTL = 30
+    LOOKUP_CACHE_SIZE = 256
+    POOL_SIZE = 4
+    POOL_IDLE_TTL = 10
     SOCKTYPES = {
         "tcp": socket.SOCK_STREAM,
         "udp": socket.SOCK_DGRAM,
     }
+    SOCKTYPENAMES = {v: k for (k, v) in SOCKTYPES.items()}
+    PORTS = {
+        "kerberos": 88,
+        "kpasswd": 464,
+    }
 
     def addr2socktypename(self, addr):
-        ret = None
-        for name in self.SOCKTYPES:
-            if self.SOCKTYPES[name] == addr[1]:
-                ret = name
-                break
-        return ret
+        return self.SOCKTYPENAMES.get(addr[1])
 
     def __init__(self):
         self.__resolver = MetaResolver()
-
-    def __await_reply(self, pr, rsocks, wsocks, timeout):
+        self.__addrinfo_cache = {}
+        self.__lookup_cache = {}
+        self.__cache_lock = threading.Lock()
+        self.__pool = {}
+        self.__pool_lock = threading.Lock()
+        self.__local = threading.local()
+
+    def __await_reply(self, sel, pr, rsocks, wsocks, timeout, idle=None):
         starting_time = time.time()
         send_error = None
         recv_error = None
         failing_sock = None
+        failing_partial = False
         reactivations = {}
         extra = 0
         read_buffers = {}
+        # If we proxy over UDP, remove the 4-byte length prefix since it is
+        # TCP only. The view is shared by all UDP sockets.
+        udp_request = memoryview(pr.request)[4:]
+        # Sockets stay registered across calls; only register new ones and
+        # switch those that are to be written to again.
+        fdmap = sel.get_map()
+        for (socks, events) in ((wsocks, selectors.EVENT_WRITE),
+                                (rsocks, selectors.EVENT_READ)):
+            for sock in socks:
+                key = fdmap.get(sock)
+                if key is None:
+                    # A socket's type never changes, keep it as the key data.
+                    sel.register(sock, events, self.sock_type(sock))
+                elif key.events != events:
+                    sel.modify(sock, events, key.data)
+
         while (timeout + extra) > time.time():
-            if not wsocks and not rsocks:
+            if not sel.get_map():
                 break
 
-            r, w, x = select.select(rsocks, wsocks, rsocks + wsocks,
-                                    (timeout + extra) - time.time())
-            for sock in x:
-                sock.close()
-                try:
-                    rsocks.remove(sock)
-                except ValueError:
-                    pass
-                try:
-                    wsocks.remove(sock)
-                except ValueError:
-                    pass
-
-            for sock in w:
-                # Fetch reactivation tuple:
-                #   1st element: reactivation index (-1 = first activation)
-                #   2nd element: planned reactivation time (0.0 = now)
-                (rn, rt) = reactivations.get(sock, (-1, 0.0))
-                if rt > time.time():
-                    continue
-                try:
-                    if self.sock_type(sock) == socket.SOCK_DGRAM:
-                        # If we proxy over UDP, remove the 4-byte length
-                        # prefix since it is TCP only.
-                        sock.sendall(pr.request[4:])
-                    else:
-                        sock.sendall(pr.request)
-                        extra = 10  # New connections get 10 extra seconds
-                except Exception as e:
-                    send_error = e
-                    failing_sock = sock
-                    reactivations[sock] = (rn + 1,
-                                           time.time() + 2.0**(rn + 1) / 10)
+            ready = sel.select((timeout + extra) - time.time())
+            for key, events in ready:
+                sock = key.fileobj
+                if events & selectors.EVENT_WRITE:
+                    # Fetch reactivation tuple:
+                    #   1st element: reactivation index (-1 = first
+                    #                activation)
+                    #   2nd element: planned reactivation time (0.0 = now)
+                    (rn, rt) = reactivations.get(sock, (-1, 0.0))
+                    if rt > time.time():
+                        continue
+                    try:
+                        if key.data == socket.SOCK_DGRAM:
+                            sock.sendall(udp_request)
+                        else:
+                            sock.sendall(pr.request)
+                            # New connections get 10 extra seconds
+                            extra = 10
+                    except OSError as e:
+                        send_error = e
+                        failing_sock = sock
+                        failing_partial = False
+                        if key.data == socket.SOCK_STREAM or \
+                           e.errno in UNREACHABLE_ERRNOS:
+                            # Neither a failed TCP connection nor an
+                            # unreachable host will recover, stop
+                            # waiting for it.
+                            sel.unregister(sock)
+                            wsocks.discard(sock)
+                            continue
+                        reactivations[sock] = (
+                            rn + 1, time.time() + 2.0**(rn + 1) / 10
+                        )
+                        continue
+                    if sock in reactivations:
+                        del reactivations[sock]
+                    sel.modify(sock, selectors.EVENT_READ, key.data)
+                    rsocks.add(sock)
+                    wsocks.discard(sock)
                     continue
-                if sock in reactivations:
-                    del reactivations[sock]
-                rsocks.append(sock)
-                wsocks.remove(sock)
 
-            for sock in r:
                 try:
-                    reply = self.__handle_recv(sock, read_buffers)
+                    reply = self.__handle_recv(sock, key.data,
+                                               read_buffers)
                 except Exception as e:
                     recv_error = e
                     failing_sock = sock
-                    if self.sock_type(sock) == socket.SOCK_STREAM:
+                    failing_partial = sock in read_buffers or \
+                        isinstance(e, ValueError)
+                    if key.data == socket.SOCK_STREAM:
                         # Remove broken TCP socket from readers
-                        rsocks.remove(sock)
+                        sel.unregister(sock)
+                        rsocks.discard(sock)
                 else:
                     if reply is not None:
+                        # A TCP socket that completed its exchange can
+                        # carry the next request.
+                        if key.data == socket.SOCK_STREAM and \
+                           idle is not None:
+                            idle.add(sock)
                         return reply
 
         if reactivations:
@@ -160,74 +222,219 @@ class Application:
                                       sum(map(lambda r: r[0],
                                               reactivations.values())),
                                       send_error),
-                                  failing_sock)
+                                  failing_sock, failing_partial)
         elif recv_error is not None:
             raise SocketException("Timeout while receiving packets after "
                                   "%.2fs: %s" % (
                                       (timeout + extra) - starting_time,
                                       recv_error),
-                                  failing_sock)
+                                  failing_sock, failing_partial)
+        elif send_error is not None:
+            raise SocketException("Sending packets failed after %.2fs: %s" %
+                                  (time.time() - starting_time, send_error),
+                                  failing_sock, failing_partial)
 
         return None
 
-    def __handle_recv(self, sock, read_buffers):
-        if self.sock_type(sock) == socket.SOCK_DGRAM:
+    def __handle_recv(self, sock, socktype, read_buffers):
+        if socktype == socket.SOCK_DGRAM:
             # For UDP sockets, recv() returns an entire datagram
-            # package. KDC sends one datagram as reply.
-            reply = sock.recv(1048576)
+            # package. KDC sends one datagram as reply.  Receive it into a
+            # per-thread scratch buffer, then copy out only what arrived.
+            scratch = getattr(self.__local, "udp_buffer", None)
+            if scratch is None:
+                scratch = memoryview(bytearray(65535))
+                self.__local.udp_buffer = scratch
+            n = sock.recv_into(scratch)
             # If we proxy over UDP, we will be missing the 4-byte
             # length prefix. So add it.
-            reply = struct.pack("!I", len(reply)) + reply
-            return reply
+            buf = bytearray(4 + n)
+            UINT32.pack_into(buf, 0, n)
+            buf[4:] = scratch[:n]
+            return buf
 
         # TCP is a different story. The reply must be buffered until the full
-        # answer is accumulated.
-        buf = read_buffers.get(sock)
+        # answer is accumulated. Read the 4-byte length prefix first, then
+        # fill a buffer sized for the whole reply.
+        buf, filled = read_buffers.get(sock, (None, 0))
         if buf is None:
-            read_buffers[sock] = buf = io.BytesIO()
+            buf = bytearray(4)
 
-        part = sock.recv(1048576)
-        if not part:
+        n = sock.recv_into(memoryview(buf)[filled:])
+        if not n:
             # EOF received.  Return any incomplete data we have on the theory
             # that a decode error is more apparent than silent failure.  The
-            # client will fail faster, at least.
-            read_buffers.pop(sock)
-            reply = buf.getvalue()
-            return reply
-
-        # Data received, accumulate it in a buffer.
-        buf.write(part)
+            # client will fail faster, at least.  A connection closed before
+            # any reply, e.g. a pooled one the KDC timed out, is a failure.
+            read_buffers.pop(sock, None)
+            if not filled:
+                raise EOFError("Connection closed before a reply.")
+            return buf[:filled]
+
+        filled += n
+        if filled == len(buf) == 4:
+            # Got the length prefix, make room for the rest of the reply.
+            (length, ) = UINT32.unpack_from(buf)
+            if length > self.MAX_REPLY_LENGTH:
+                read_buffers.pop(sock, None)
+                raise ValueError("Reply length %d exceeds maximum of %d." %
+                                 (length, self.MAX_REPLY_LENGTH))
+            header, buf = buf, bytearray(4 + length)
+            buf[:4] = header
+
+        if filled == len(buf):
+            read_buffers.pop(sock, None)
+            return buf
+
+        read_buffers[sock] = (buf, filled)
+        return None
 
-        reply = buf.getvalue()
-        if len(reply) < 4:
-            # We don't have the length yet.
+    def __connect(self, addr):
+        # Where supported, have the socket created non-blocking rather than
+        # switching it after.
+        sock = socket.socket(addr[0], addr[1] | SOCK_NONBLOCK, addr[2])
+        if not SOCK_NONBLOCK:
+            sock.setblocking(0)
+        if addr[1] == socket.SOCK_STREAM:
+            # Requests go out in one write, don't let Nagle hold it back.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Connect; a non-blocking connect() in progress raises
+        # BlockingIOError.
+        try:
+            sock.connect(addr[4])
+        except BlockingIOError:
+            pass
+        except OSError:
+            sock.close()
             return None
+        return sock
 
-        # Got enough data to check if we have the full package.
-        (length, ) = struct.unpack("!I", reply[0:4])
-        if length + 4 == len(reply):
-            read_buffers.pop(sock)
-            return reply
-
+    def __is_idle(self, sock):
+        # An idle connection has nothing to read; EOF or stray data means the
+        # KDC closed it or is out of step with us.
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def __checkout(self, addr):
+        now = time.monotonic()
+        with self.__pool_lock:
+            pooled = self.__pool.get(addr)
+            while pooled:
+                expires, sock = pooled.pop()
+                if expires > now and self.__is_idle(sock):
+                    return sock
+                sock.close()
         return None
 
-    def __filter_addr(self, addr):
-        if addr[0] not in (socket.AF_INET, socket.AF_INET6):
+    def __checkin(self, addr, sock):
+        if not self.__is_idle(sock):
             return False
 
-        if addr[1] not in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+        now = time.monotonic()
+        with self.__pool_lock:
+            pooled = []
+            for entry in self.__pool.get(addr, ()):
+                if entry[0] > now:
+                    pooled.append(entry)
+                else:
+                    entry[1].close()
+            self.__pool[addr] = pooled
+            if len(pooled) >= self.POOL_SIZE:
+                return False
+            pooled.append((now + self.POOL_IDLE_TTL, sock))
+        return True
+
+    def __read_body(self, stream, length):
+        # One read() returns the whole body with most servers, but a short
+        # read must not truncate the request.
+        body = stream.read(length)
+        if len(body) < length:
+            parts = [body]
+            length -= len(body)
+            while length > 0:
+                part = stream.read(length)
+                if not part:
+                    break
+                parts.append(part)
+                length -= len(part)
+            body = b"".join(parts)
+        return body
+
+    @staticmethod
+    def __filter_addr(addr):
+        if addr[0] not in ADDR_FAMILIES:
             return False
 
-        if addr[2] not in (socket.IPPROTO_TCP, socket.IPPROTO_UDP):
+        if addr[1] not in ADDR_SOCKTYPES:
+            return False
+
+        if addr[2] not in ADDR_PROTOCOLS:
             return False
 
         return True
 
+    def __lookup(self, realm, kpasswd):
+        key = (realm, kpasswd)
+        now = time.monotonic()
+        entry = self.__lookup_cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        servers = tuple(map(parse_kdc_url,
+                            self.__resolver.lookup(realm, kpasswd=kpasswd)))
+        if servers:
+            # Realms come from the client, keep the cache bounded.
+            self.__cache_put(self.__lookup_cache, self.LOOKUP_CACHE_SIZE,
+                             key, (now + self.LOOKUP_TTL, servers), now)
+        return servers
+
+    def __getaddrinfo(self, host, port, socktype=0):
+        key = (host, port, socktype)
+        now = time.monotonic()
+        entry = self.__addrinfo_cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        if socktype:
+            # Let the resolver leave out the other socktype.
+            addrs = tuple(filter(self.__filter_addr,
+                                 socket.getaddrinfo(host, port, 0, socktype)))
+        else:
+            # Sort addresses so that we get TCP first.
+            addrs = tuple(sorted(filter(self.__filter_addr,
+                                        socket.getaddrinfo(host, port)),
+                                 key=lambda a: a[2]))
+        self.__cache_put(self.__addrinfo_cache, self.ADDRINFO_CACHE_SIZE,
+                         key, (now + self.ADDRINFO_TTL, addrs), now)
+        return addrs
+
+    def __cache_put(self, cache, size, key, entry, now):
+        # Request threads share the caches; reads are single dict.get()
+        # calls, but purging, inserting and dropping must not interleave.
+        with self.__cache_lock:
+            if len(cache) >= size:
+                for k, v in list(cache.items()):
+                    if v[0] <= now:
+                        cache.pop(k, None)
+                if len(cache) >= size:
+                    # Still full, drop the oldest entry.
+                    del cache[next(iter(cache))]
+            cache[key] = entry
+
+    def __cache_drop(self, cache, key):
+        with self.__cache_lock:
+            cache.pop(key, None)
+
     def sock_type(self, sock):
-        try:
-            return sock.type & ~socket.SOCK_NONBLOCK
-        except AttributeError:
-            return sock.type
+        # Since Python 3.7, socket.type no longer includes the
+        # SOCK_NONBLOCK and SOCK_CLOEXEC flags.
+        return sock.type
 
     def __call__(self, env, start_response):
         try:
@@ -245,28 +452,31 @@ class Application:
             except ValueError:
                 pass
             if length < 0:
-                raise HTTPException(411, "Length required.")
+                raise HTTPException(411, b"Length required.")
             if length > self.MAX_LENGTH:
-                raise HTTPException(413, "Request entity too large.")
+                raise HTTPException(413, b"Request entity too large.")
             try:
-                pr = codec.decode(env["wsgi.input"].read(length))
+                pr = codec.decode(self.__read_body(env["wsgi.input"], length))
             except codec.ParsingError as e:
                 raise HTTPException(400, e.message)
 
             # Find the remote proxy
-            servers = self.__resolver.lookup(
-                pr.realm,
-                kpasswd=isinstance(pr, codec.KPASSWDProxyRequest)
-            )
+            kpasswd = isinstance(pr, codec.KPASSWDProxyRequest)
+            servers = self.__lookup(pr.realm, kpasswd)
             if not servers:
                 raise HTTPException(503, "Can't find remote (%s)." % pr)
 
             # Contact the remote server
             reply = None
-            wsocks = []
-            rsocks = []
+            socks = []
+            wsocks = set()
+            rsocks = set()
+            idle = set()
+            pooled = set()
+            udp_socks = set()
             sockfno2addr = {}
-            for server in map(urlparse.urlparse, servers):
+            sel = selectors.DefaultSelector()
+            for server in servers:
                 # Enforce valid, supported URIs
                 scheme = server.scheme.lower().split("+", 1)
                 if scheme[0] not in ("kerberos", "kpasswd"):
@@ -275,81 +485,146 @@ class Application:
                     continue
 
                 # Do the DNS lookup
+                port = server.port
+                if port is None:
+                    # Numeric, so getaddrinfo has no service to look up.
+                    port = self.PORTS[scheme[0]]
+                socktype = 0
+                if len(scheme) > 1:
+                    socktype = self.SOCKTYPES[scheme[1]]
                 try:
-                    port = server.port
-                    if port is None:
-                        port = scheme[0]
-                    addrs = socket.getaddrinfo(server.hostname, port)
+                    addrs = self.__getaddrinfo(server.hostname, port, socktype)
                 except socket.gaierror:
                     continue
 
-                # Sort addresses so that we get TCP first.
-                #
                 # Stick a None address on the end so we can get one
                 # more attempt after all servers have been contacted.
-                addrs = tuple(sorted(filter(self.__filter_addr, addrs),
-                                     key=lambda a: a[2]))
                 for addr in addrs + (None,):
                     if addr is not None:
-                        # Bypass unspecified socktypes
-                        if len(scheme) > 1 and \
-                           addr[1] != self.SOCKTYPES[scheme[1]]:
-                            continue
-
-                        # Create the socket
-                        sock = socket.socket(*addr[:3])
-                        sock.setblocking(0)
-
-                        # Connect
-                        try:
-                            # In Python 2.x, non-blocking connect() throws
-                            # socket.error() with errno == EINPROGRESS. In
-                            # Python 3.x, it throws io.BlockingIOError().
-                            sock.connect(addr[4])
-                        except socket.error as e:
-                            if e.errno != errno.EINPROGRESS:
-                                sock.close()
+                        # Reuse an idle connection or create the socket
+                        sock = None
+                        if addr[1] == socket.SOCK_STREAM:
+                            sock = self.__checkout(addr)
+                            if sock is not None:
+                                pooled.add(sock.fileno())
+                        if sock is None:
+                            sock = self.__connect(addr)
+                            if sock is None:
                                 continue
-                        except io.BlockingIOError:
-                            pass
                         sockfno2addr[sock.fileno()] = addr
-                        wsocks.append(sock)
+                        socks.append(sock)
+                        wsocks.add(sock)
+                        if addr[1] == socket.SOCK_DGRAM:
+                            udp_socks.add(sock)
 
                     # Resend packets to UDP servers
-                    for sock in tuple(rsocks):
-                        if self.sock_type(sock) == socket.SOCK_DGRAM:
-                            wsocks.append(sock)
-                            rsocks.remove(sock)
+                    resend = rsocks & udp_socks
+                    wsocks |= resend
+                    rsocks -= resend
 
                     # Call select()
                     timeout = time.time() + (15 if addr is None else 2)
-                    try:
-                        reply = self.__await_reply(pr, rsocks, wsocks, timeout)
-                    except SocketException as e:
-                        fail_addr = sockfno2addr[e.sockfno]
-                        fail_socktype = self.addr2socktypename(fail_addr)
-                        fail_ip = fail_addr[4][0]
-                        fail_port = fail_addr[4][1]
-                        logger.warning("Exchange with %s:[%s]:%d failed: %s",
-                                       fail_socktype, fail_ip, fail_port, e)
+                    while True:
+                        try:
+                            reply = self.__await_reply(sel, pr, rsocks,
+                                                       wsocks, timeout, idle)
+                        except SocketException as e:
+                            fail_addr = sockfno2addr[e.sockfno]
+                            if e.sockfno in pooled and not e.partial:
+                                # The KDC closed the idle connection while
+                                # it was handed out, before answering; try
+                                # once more over a new one.
+                                pooled.discard(e.sockfno)
+                                sock = self.__connect(fail_addr)
+                                if sock is not None:
+                                    sockfno2addr[sock.fileno()] = fail_addr
+                                    socks.append(sock)
+                                    wsocks.add(sock)
+                                    timeout = max(timeout, time.time() + 2)
+                                    continue
+                            logger.warning(
+                                "Exchange with %s:[%s]:%d failed: %s",
+                                self.addr2socktypename(fail_addr),
+                                fail_addr[4][0], fail_addr[4][1], e
+                            )
+                            # The KDC may have moved; resolve it afresh
+                            # next time.
+                            self.__cache_drop(
+                                self.__addrinfo_cache,
+                                (server.hostname, port, socktype)
+                            )
+                        break
                     if reply is not None:
                         break
 
                 if reply is not None:
                     break
 
-            for sock in rsocks + wsocks:
+            sel.close()
+            for sock in socks:
+                if sock in idle and \
+                   self.__checkin(sockfno2addr[sock.fileno()], sock):
+                    continue
                 sock.close()
 
             if reply is None:
+                # None of the servers answered; look them up again next time.
+                self.__cache_drop(self.__lookup_cache, (pr.realm, kpasswd))
                 raise HTTPException(503, "Remote unavailable (%s)." % pr)
 
             # Return the result to the client
-            raise HTTPException(200, codec.encode(reply),
-                                [("Content-Type", "application/kerberos")])
+            reply = codec.encode(reply)
+            start_response("200 OK", [
+                ("Content-Type", "application/kerberos"),
+                ("Content-Length", str(len(reply))),
+            ])
+            return [reply]
         except HTTPException as e:
             start_response(str(e), e.headers)
             return [e.message]
 
+    async def asgi(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        # Buffer the body, but no more of it than we would ever accept.
+        body = []
+        size = 0
+        more_body = True
+        while more_body and size <= self.MAX_LENGTH:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            body.append(message.get("body", b""))
+            size += len(body[-1])
+            more_body = message.get("more_body", False)
+
+        env = {
+            "REQUEST_METHOD": scope["method"],
+            "wsgi.input": io.BytesIO(b"".join(body)),
+        }
+        for (name, value) in scope["headers"]:
+            if name.lower() == b"content-length":
+                env["CONTENT_LENGTH"] = value.decode("latin-1")
+
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(k.lower().encode("latin-1"),
+                                    v.encode("latin-1"))
+                                   for (k, v) in headers]
+
+        # The exchange with the KDCs blocks, keep it off the event loop.
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(None, self, env, start_response)
+        await send({
+            "type": "http.response.start",
+            "status": response["status"],
+            "headers": response["headers"],
+        })
+        await send({"type": "http.response.body", "body": b"".join(chunks)})
+
 
 application = Application()
+asgi = application.asgi
@@ -19,11 +19,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import functools
 import struct
 
-from kdcproxy import parse_pyasn1 as asn1mod
+try:
+    # asn1crypto decodes several times faster than pyasn1.
+    from kdcproxy import parse_asn1crypto as asn1mod
+except ImportError:
+    from kdcproxy import parse_pyasn1 as asn1mod
 from kdcproxy.exceptions import ParsingError
 
+UINT16 = struct.Struct("!H")
+UINT32 = struct.Struct("!I")
+
+# Requests up to this size are remembered by decode(), see there.
+DECODE_CACHE_LIMIT = 8192
+
 
 class ProxyRequest(object):
     TYPE = None
@@ -34,11 +45,22 @@ class ProxyRequest(object):
         request, realm, _ = asn1mod.decode_proxymessage(data)
 
         # Check the length of the whole request message.
-        (length, ) = struct.unpack("!I", request[0:4])
+        (length, ) = UINT32.unpack_from(request, 0)
         if length + 4 != len(request):
             raise ParsingError("Invalid request length.")
 
-        for subcls in cls.__subclasses__():
+        # AS and TGS requests announce themselves by their first byte, so
+        # try that type first instead of decoding it as every type in turn.
+        tried = REQUEST_TAGS.get(request[4:5])
+        if tried is not None:
+            try:
+                return tried.parse_request(realm, request)
+            except ParsingError:
+                pass
+
+        for subcls in REQUEST_TYPES:
+            if subcls is tried:
+                continue
             try:
                 return subcls.parse_request(realm, request)
             except ParsingError:
@@ -78,21 +100,21 @@ class KPASSWDProxyRequest(ProxyRequest):
         # Check the length count in the password change request, assuming it
         # actually is a password change request.  It should be the length of
         # the rest of the request, including itself.
-        (length, ) = struct.unpack("!H", request[4:6])
+        (length, ) = UINT16.unpack_from(request, 4)
         if length != len(request) - 4:
             raise ParsingError("Parsing the KPASSWD request length failed.")
 
         # Check the version number in the password change request, assuming it
         # actually is a password change request.  Officially we support version
         # 1, but 0xff80 is used for set-password, so try to accept that, too.
-        (version, ) = struct.unpack("!H", request[6:8])
+        (version, ) = UINT16.unpack_from(request, 6)
         if version != 0x0001 and version != 0xff80:
             raise ParsingError("The KPASSWD request is an incorrect version.")
 
         # Read the length of the AP-REQ part of the change request.  There
         # should be at least that may bytes following this length, since the
         # rest of the request is the KRB-PRIV message.
-        (length, ) = struct.unpack("!H", request[8:10])
+        (length, ) = UINT16.unpack_from(request, 8)
         if length > len(request) - 10:
             raise ParsingError("The KPASSWD request appears to be truncated.")
 
@@ -112,7 +134,26 @@ class KPASSWDProxyRequest(ProxyRequest):
         return tmp
 
 
+REQUEST_TYPES = (TGSProxyRequest, ASProxyRequest, KPASSWDProxyRequest)
+
+# DER identifier octets of [APPLICATION 10] and [APPLICATION 12].
+REQUEST_TAGS = {
+    b"\x6a": ASProxyRequest,
+    b"\x6c": TGSProxyRequest,
+}
+
+
+@functools.lru_cache(maxsize=128)
+def _decode_cached(data):
+    return ProxyRequest.parse(data)
+
+
 def decode(data):
+    # A client that retries sends the very same message again, so keep the
+    # last few parsed requests; they are not modified after parsing.
+    # Failures are not cached, and large messages are not worth keeping.
+    if isinstance(data, bytes) and len(data) <= DECODE_CACHE_LIMIT:
+        return _decode_cached(data)
     return ProxyRequest.parse(data)
 
 
@@ -19,22 +19,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import configparser
 import importlib
-import itertools
 import logging
+import operator
 import os
-
-try:  # Python 3.x
-    import configparser
-except ImportError:  # Python 2.x
-    import ConfigParser as configparser
-
-import dns.rdatatype
-import dns.resolver
+import threading
+import time
 
 logging.basicConfig()
 logger = logging.getLogger('kdcproxy')
 
+# Service names, indexed by the kpasswd flag of lookup().
+SERVICES = ("kerberos", "kpasswd")
+PRIORITY = operator.attrgetter("priority")
+
 
 class IResolver(object):
 
@@ -53,34 +52,75 @@ class IConfig(IResolver):
 class KDCProxyConfig(IConfig):
     GLOBAL = "global"
     default_filenames = ["/usr/local/etc/kdcproxy.conf", "/etc/kdcproxy.conf"]
+    __parsed = {}
+    __parsed_lock = threading.Lock()
 
     def __init__(self, filenames=None):
-        self.__cp = configparser.ConfigParser()
         if filenames is None:
             filenames = os.environ.get("KDCPROXY_CONFIG", None)
         if filenames is None:
             filenames = self.default_filenames
-        try:
-            self.__cp.read(filenames)
-        except configparser.Error:
-            logger.error("Unable to read config file(s): %s", filenames)
+        self.__cp = self.__parse(filenames)
+
+        # Resolve the server lists up front, lookup() runs per request.
+        self.__servers = {}
+        for realm in self.__cp.sections():
+            for service in SERVICES:
+                try:
+                    servers = self.__cp.get(realm, service)
+                except configparser.Error:
+                    continue
+                key = (realm, service)
+                self.__servers[key] = tuple(servers.split())
 
         try:
             mod = self.__cp.get(self.GLOBAL, "configs")
             try:
                 importlib.import_module("kdcproxy.config." + mod)
             except ImportError as e:
-                logger.log(logging.ERROR, "Error reading config: %s" % e)
+                logger.error("Error reading config: %s", e)
         except configparser.Error:
             pass
 
-    def lookup(self, realm, kpasswd=False):
-        service = "kpasswd" if kpasswd else "kerberos"
+    @classmethod
+    def __parse(cls, filenames):
+        # Parsed files are shared between instances until one of them
+        # changes; the parser is only ever read from after this.
+        if isinstance(filenames, str):
+            filenames = (filenames, )
+        key = tuple(filenames)
+        mtimes = tuple(map(cls.__mtime, key))
+        with cls.__parsed_lock:
+            entry = cls.__parsed.get(key)
+            if entry is not None and entry[0] == mtimes:
+                return entry[1]
+
+        # Read each file in one go and parse it from memory, skipping
+        # files that do not exist, like ConfigParser.read() does.
+        cp = configparser.ConfigParser()
+        for filename in key:
+            try:
+                with open(filename) as f:
+                    data = f.read()
+            except OSError:
+                continue
+            try:
+                cp.read_string(data, source=filename)
+            except configparser.Error:
+                logger.error("Unable to read config file: %s", filename)
+        with cls.__parsed_lock:
+            cls.__parsed[key] = (mtimes, cp)
+        return cp
+
+    @staticmethod
+    def __mtime(filename):
         try:
-            servers = self.__cp.get(realm, service)
-            return map(lambda s: s.strip(), servers.strip().split(" "))
-        except configparser.Error:
-            return ()
+            return os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def lookup(self, realm, kpasswd=False):
+        return self.__servers.get((realm, SERVICES[kpasswd]), ())
 
     def use_dns(self):
         try:
@@ -90,34 +130,111 @@ class KDCProxyConfig(IConfig):
 
 
 class DNSResolver(IResolver):
+    PROTOCOLS = ("tcp", "udp")
+    CACHE_SIZE = 1024
+    NEGATIVE_TTL = 5
+    LIFETIME = 5.0
+
+    def __init__(self):
+        self.__cache = {}
+        self.__cache_lock = threading.Lock()
+        self.__query = None
+
+    def __cached(self, service, protocol, realm):
+        entry = self.__cache.get((service, protocol, realm))
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
 
     def __dns(self, service, protocol, realm):
+        key = (service, protocol, realm)
+        now = time.monotonic()
+
+        # dnspython is imported once a query has to go out, so processes
+        # that are configured without DNS never load it.
+        import dns.rdatatype
+        import dns.resolver
+
         query = '_%s._%s.%s' % (service, protocol, realm)
 
         try:
-            reply = dns.resolver.query(query, dns.rdatatype.SRV)
+            if self.__query is None:
+                # Set up our own resolver with a bounded lifetime on first
+                # use, so a missing resolv.conf fails the query rather than
+                # the constructor.  dnspython 2 renamed query to resolve.
+                resolver = dns.resolver.Resolver()
+                resolver.lifetime = self.LIFETIME
+                resolve = getattr(resolver, "resolve", None)
+                if resolve is None:
+                    resolve = resolver.query
+                self.__query = resolve
+            reply = self.__query(query, dns.rdatatype.SRV)
         except dns.exception.DNSException:
             reply = []
 
         # FIXME: pay attention to weighting, preferably while still
         # arriving at the same answer every time, for the sake of
         # clients that are having longer conversations with servers.
-        reply = sorted(reply, key=lambda r: r.priority)
-
-        for entry in reply:
-            host = str(entry.target).rstrip('.')
-            yield (host, entry.port)
+        servers = tuple((str(entry.target).rstrip('.'), entry.port)
+                        for entry in sorted(reply, key=PRIORITY))
+
+        # Keep the answer for as long as the SRV records say it is valid.
+        # Missing records are remembered briefly, so that a realm without
+        # them does not send every request out to DNS.
+        ttl = reply.rrset.ttl if servers else self.NEGATIVE_TTL
+        with self.__cache_lock:
+            # Queries run on several threads at once.
+            if len(self.__cache) >= self.CACHE_SIZE:
+                del self.__cache[next(iter(self.__cache))]
+            self.__cache[key] = (now + ttl, servers)
+        return servers
+
+    def __resolve(self, queries, realm):
+        results = [self.__cached(service, protocol, realm)
+                   for (service, protocol) in queries]
+        missing = [i for (i, servers) in enumerate(results) if servers is None]
+        errors = []
+
+        def run(i):
+            try:
+                results[i] = self.__dns(queries[i][0], queries[i][1], realm)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        # The queries are independent, so wait for them concurrently: the
+        # first one here, the others in threads of their own.  A slow
+        # nameserver then only holds up the request that is waiting on it,
+        # not every other request's queries as a shared pool would.
+        threads = [threading.Thread(target=run, args=(i, ), daemon=True)
+                   for i in missing[1:]]
+        for thread in threads:
+            thread.start()
+        if missing:
+            run(missing[0])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
 
     def lookup(self, realm, kpasswd=False):
-        service = "kpasswd" if kpasswd else "kerberos"
-
-        for protocol in ("tcp", "udp"):
-            servers = tuple(self.__dns(service, protocol, realm))
+        service = SERVICES[kpasswd]
+
+        queries = [(service, p) for p in self.PROTOCOLS]
+        if kpasswd:
+            # Ask for the kerberos-adm fallback right away rather than
+            # waiting for the kpasswd records to come back empty first.
+            queries += [("kerberos-adm", p) for p in self.PROTOCOLS]
+        results = self.__resolve(queries, realm)
+
+        prefix = service + "://"
+        for i in range(len(self.PROTOCOLS)):
+            servers = results[i]
             if not servers and kpasswd:
-                servers = self.__dns("kerberos-adm", protocol, realm)
+                servers = results[i + len(self.PROTOCOLS)]
 
             for host, port in servers:
-                yield "%s://%s:%d" % (service, host, port)
+                yield f"{prefix}{host}:{port}"
 
 
 class MetaResolver(IResolver):
@@ -127,17 +244,18 @@ class MetaResolver(IResolver):
 
     def __init__(self):
         self.__resolvers = []
-        for i in itertools.count(0):
+        allsub = IConfig.__subclasses__()
+        done = 0
+        while done < len(allsub):
+            for sub in allsub[done:]:
+                try:
+                    self.__resolvers.append(sub())
+                except Exception as e:
+                    logger.warning("Error instantiating %s due to %r",
+                                   sub, e)
+            # Instantiating a config may import further config modules.
+            done = len(allsub)
             allsub = IConfig.__subclasses__()
-            if not i < len(allsub):
-                break
-
-            try:
-                self.__resolvers.append(allsub[i]())
-            except Exception as e:
-                fmt = (allsub[i], repr(e))
-                logging.log(logging.WARNING,
-                            "Error instantiating %s due to %s" % fmt)
         assert self.__resolvers
 
         # See if we should use DNS
@@ -152,18 +270,15 @@ class MetaResolver(IResolver):
         if dns in (None, True):
             self.__resolvers.append(DNSResolver())
 
-    def __unique(self, items):
-        "Removes duplicate items from an iterable while maintaining order."
-        items = tuple(items)
-        unique = set(items)
-        for item in items:
-            if item in unique:
-                unique.remove(item)
-                yield item
-
     def lookup(self, realm, kpasswd=False):
         for r in self.__resolvers:
-            servers = tuple(self.__unique(r.lookup(realm, kpasswd)))
+            servers = r.lookup(realm, kpasswd)
+            if servers == ():
+                # The configs answer realms they do not know with an
+                # empty tuple, there is nothing to deduplicate.
+                continue
+            # Drop duplicates, keeping the first occurrence of each.
+            servers = tuple(dict.fromkeys(servers))
             if servers:
                 return servers
 
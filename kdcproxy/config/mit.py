@@ -20,12 +20,10 @@
 # THE SOFTWARE.
 
 import ctypes
+import os
 import sys
-
-try:
-    import urllib.parse as urlparse
-except ImportError:  # pragma: no cover
-    import urlparse
+import threading
+import weakref
 
 from kdcproxy.config import IConfig
 
@@ -34,7 +32,10 @@ class KRB5Error(Exception):
     pass
 
 
-PY3 = sys.version_info[0] == 3
+# profile.h flags for profile_iterator_create()
+PROFILE_ITER_LIST_SECTION = 0x0001
+PROFILE_ITER_SECTIONS_ONLY = 0x0002
+PROFILE_ITER_RELATIONS_ONLY = 0x0004
 
 
 try:
@@ -48,9 +49,7 @@ else:
         def from_param(cls, value):
             if value is None:
                 return None
-            if PY3 and isinstance(value, str):
-                return value.encode('utf-8')
-            elif not PY3 and isinstance(value, unicode):  # noqa
+            if isinstance(value, str):
                 return value.encode('utf-8')
             elif not isinstance(value, bytes):
                 raise TypeError(value)
@@ -62,9 +61,7 @@ else:
             value = self.value
             if value is None:
                 return None
-            elif not isinstance(value, str):
-                return value.decode('utf-8')
-            return value
+            return value.decode('utf-8')
 
     class _krb5_context(ctypes.Structure):  # noqa
         """krb5/krb5.h struct _krb5_context"""
@@ -137,7 +134,8 @@ else:
 class KRB5Profile:
 
     class Iterator:
-        def __init__(self, profile, *args):
+        def __init__(self, profile, *args,
+                     flags=PROFILE_ITER_LIST_SECTION):
             # Convert string arguments to UTF8 bytes
             args = [c_text_p.from_param(arg) for arg in args]
             args.append(None)
@@ -148,60 +146,59 @@ class KRB5Profile:
             self.__iterator = iter_p()
             profile_iterator_create(profile,
                                     self.__path,
-                                    1,
+                                    flags,
                                     ctypes.byref(self.__iterator))
 
         def __iter__(self):
             return self
 
         def __next__(self):
-            try:
+            if self.__iterator:
                 name = c_text_p()
                 value = c_text_p()
-                profile_iterator(ctypes.byref(self.__iterator),
-                                 ctypes.byref(name),
-                                 ctypes.byref(value))
-                if not name.value:
-                    raise KRB5Error
-                return name.text, value.text
-            except KRB5Error:
+                try:
+                    profile_iterator(ctypes.byref(self.__iterator),
+                                     ctypes.byref(name),
+                                     ctypes.byref(value))
+                except KRB5Error:
+                    pass
+                # The end of the section comes back as a NULL name, so
+                # only errors need to go through an exception.
+                if name.value:
+                    return name.text, value.text
                 profile_iterator_free(ctypes.byref(self.__iterator))
                 self.__iterator = None
-                raise StopIteration()
+            raise StopIteration()
 
         def __del__(self):
             if self.__iterator:  # pragma: no cover
                 profile_iterator_free(ctypes.byref(self.__iterator))
                 self.__iterator = None
 
-        # Handle iterator API change
-        if not PY3:
-            next = __next__
-
     def __init__(self):
-        self.__context = self.__profile = None
         if isinstance(LIBKRB5, Exception):  # pragma: no cover
             raise LIBKRB5
         context = krb5_context()
         krb5_init_context(ctypes.byref(context))
-        self.__context = context
         profile = profile_t()
+        # Released on __exit__, or when the object is collected; the
+        # finalizer runs at most once either way.
+        self.__release = weakref.finalize(self, self.__free, context, profile)
         krb5_get_profile(context, ctypes.byref(profile))
         self.__profile = profile
 
+    @staticmethod
+    def __free(context, profile):
+        krb5_free_context(context)
+        if profile:
+            profile_release(profile)
+
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        if self.__context:
-            krb5_free_context(self.__context)
-            self.__context = None
-        if self.__profile:
-            profile_release(self.__profile)
-            self.__profile = None
-
-    def __del__(self):
-        self.__exit__(None, None, None)
+        self.__release()
+        self.__profile = None
 
     def __getitem__(self, name):
         return self.section(name)
@@ -225,51 +222,102 @@ class KRB5Profile:
 
         return output
 
+    def subsections(self, *args):
+        flags = PROFILE_ITER_LIST_SECTION | PROFILE_ITER_SECTIONS_ONLY
+        iterator = KRB5Profile.Iterator(self.__profile, *args, flags=flags)
+        return [name for name, _ in iterator]
+
+    def relations(self, *args):
+        flags = PROFILE_ITER_LIST_SECTION | PROFILE_ITER_RELATIONS_ONLY
+        return list(KRB5Profile.Iterator(self.__profile, *args, flags=flags))
+
 
 class MITConfig(IConfig):
-    CONFIG_KEYS = ('kdc', 'admin_server', 'kpasswd_server')
+    CONFIG_KEYS = frozenset(('kdc', 'admin_server', 'kpasswd_server'))
+    DEFAULT_PROFILE_PATH = "/etc/krb5.conf"
+    __parsed = {}
+    __parsed_lock = threading.Lock()
 
     def __init__(self, *args, **kwargs):
-        self.__config = {}
+        # Share the parsed profile between instances until one of its files
+        # changes.  Files pulled in with include/includedir are not checked.
+        paths = os.environ.get("KRB5_CONFIG", self.DEFAULT_PROFILE_PATH)
+        mtimes = tuple(map(self.__mtime, paths.split(":")))
+        with self.__parsed_lock:
+            entry = self.__parsed.get(paths)
+        if entry is not None and entry[0] == mtimes:
+            self.__config = entry[1]
+            return
+
+        self.__config = self.__load()
+        with self.__parsed_lock:
+            self.__parsed[paths] = (mtimes, self.__config)
+
+    @staticmethod
+    def __mtime(filename):
+        try:
+            return os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+
+    @classmethod
+    def __load(cls):
+        config = {}
         with KRB5Profile() as prof:
-            # Load DNS setting
-            self.__config["dns"] = prof.get_bool("libdefaults",
-                                                 "dns_fallback",
-                                                 default=True)
-            if "dns_lookup_kdc" in dict(prof.section("libdefaults")):
-                self.__config["dns"] = prof.get_bool("libdefaults",
-                                                     "dns_lookup_kdc",
-                                                     default=True)
+            # Load DNS setting; dns_lookup_kdc overrides dns_fallback.
+            # profile_get_boolean() returns the default for unset
+            # relations, so there is no need to walk [libdefaults].
+            dns = prof.get_bool("libdefaults", "dns_fallback", default=True)
+            config["dns"] = prof.get_bool("libdefaults", "dns_lookup_kdc",
+                                          default=dns)
 
             # Load all configured realms
-            self.__config["realms"] = {}
-            for realm, values in prof.section("realms"):
-                rconf = self.__config["realms"].setdefault(realm, {})
-                for server, hostport in values:
-                    if server not in self.CONFIG_KEYS:
+            realms = {}
+            # Only the realms' own relations matter, so let libkrb5 skip
+            # their subsections instead of walking them with section().
+            for realm in prof.subsections("realms"):
+                rconf = realms.setdefault(realm, {})
+                for server, hostport in prof.relations("realms", realm):
+                    if server not in cls.CONFIG_KEYS:
                         continue
 
-                    parsed = urlparse.urlparse(hostport)
-                    if parsed.hostname is None:
-                        scheme = {'kdc': 'kerberos'}.get(server, 'kpasswd')
-                        parsed = urlparse.urlparse(scheme + "://" + hostport)
-
-                    if parsed.port is not None and server == 'admin_server':
-                        hostport = hostport.split(':', 1)[0]
-                        parsed = urlparse.urlparse("kpasswd://" + hostport)
+                    # An insertion ordered dict drops repeated servers.
+                    url = cls.__server_url(server, hostport)
+                    rconf.setdefault(server, {})[url] = None
+
+        # Store what lookup() returns, keyed by (realm, kpasswd).
+        config["servers"] = {}
+        for realm, rconf in realms.items():
+            config["servers"][(realm, False)] = tuple(rconf.get('kdc', ()))
+            kpasswd = dict(rconf.get('kpasswd_server', ()))
+            kpasswd.update(rconf.get('admin_server', ()))
+            config["servers"][(realm, True)] = tuple(kpasswd)
+        return config
+
+    @staticmethod
+    def __server_url(server, hostport):
+        # Entries are "host[:port]" or already "scheme://host[:port]"; no
+        # need for urlparse() to tell them apart.
+        scheme, sep, netloc = hostport.partition("://")
+        if not sep:
+            scheme = {'kdc': 'kerberos'}.get(server, 'kpasswd')
+            netloc = hostport
+
+        if server == 'admin_server':
+            # The admin server's port is kadmind's; kpasswd listens on
+            # its own default port on that host.
+            if netloc.startswith("["):
+                host, _, port = netloc.partition("]")
+                host += "]"
+            else:
+                host, _, port = netloc.partition(":")
+            if port:
+                scheme, netloc = 'kpasswd', host
 
-                    rconf.setdefault(server, []).append(parsed.geturl())
+        return "%s://%s" % (scheme.lower(), netloc)
 
     def lookup(self, realm, kpasswd=False):
-        rconf = self.__config.get("realms", {}).get(realm, {})
-
-        if kpasswd:
-            servers = list(rconf.get('kpasswd_server', []))
-            servers.extend(rconf.get('admin_server', []))
-        else:
-            servers = rconf.get('kdc', [])
-
-        return tuple(servers)
+        return self.__config["servers"].get((realm, kpasswd), ())
 
     def use_dns(self, default=True):
         return self.__config["dns"]
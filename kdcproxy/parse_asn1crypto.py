@@ -0,0 +1,116 @@
+# Copyright (C) 2013, Red Hat, Inc.
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from asn1crypto import core, parser
+
+from kdcproxy.exceptions import ASN1ParsingError, ParsingError
+
+
+class KerberosString(core.GeneralString):
+    """KerberosString ::= GeneralString (IA5String)"""
+
+
+class Realm(KerberosString):
+    """Realm ::= KerberosString"""
+
+
+class KdcProxyMessage(core.Sequence):
+    """KDC-PROXY-MESSAGE"""
+    _fields = [
+        ('kerb-message', core.OctetString, {'explicit': 0}),
+        ('target-domain', Realm, {'explicit': 1, 'optional': True}),
+        ('dclocator-hint', core.Integer, {'explicit': 2, 'optional': True}),
+    ]
+
+
+class ASREQ(core.Sequence):
+    pretty_name = 'AS-REQ'
+    explicit = (1, 10)
+
+
+class TGSREQ(core.Sequence):
+    pretty_name = 'TGS-REQ'
+    explicit = (1, 12)
+
+
+class APREQ(core.Sequence):
+    pretty_name = 'AP-REQ'
+    explicit = (1, 14)
+
+
+class KRBPriv(core.Sequence):
+    pretty_name = 'KRBPRiv'
+    explicit = (1, 21)
+
+
+def decode_proxymessage(data):
+    try:
+        req = KdcProxyMessage.load(data, strict=True)
+        message = req['kerb-message'].native
+        realm = req['target-domain'].native
+        flags = req['dclocator-hint'].native
+    except ValueError as e:
+        raise ASN1ParsingError(e)
+    return message, realm, flags
+
+
+def encode_proxymessage(data):
+    rep = KdcProxyMessage()
+    # asn1crypto only takes bytes, but the KDC's reply is a bytearray.
+    rep['kerb-message'] = bytes(data)
+    return rep.dump()
+
+
+# Kerberos requests nest a dozen levels deep at most.
+MAX_DEPTH = 32
+
+
+def walk(data):
+    """Checks that data is a series of well-formed DER values"""
+    # Keep a stack instead of recursing, and give up on requests that
+    # nest deeper than any Kerberos message does.
+    stack = [(data, 1)]
+    while stack:
+        data, depth = stack.pop()
+        if depth > MAX_DEPTH:
+            raise ValueError("ASN.1 values nested too deeply.")
+        while data:
+            _, method, _, header, contents, trailer = parser.parse(data)
+            if method == 1:  # constructed
+                stack.append((contents, depth + 1))
+            data = data[len(header) + len(contents) + len(trailer):]
+
+
+def try_decode(data, cls):
+    try:
+        req = cls.load(data)
+        # load() only parses the outer tag and length; walk the content
+        # too, so that requests with broken framing fail.  Unlike pyasn1,
+        # this does not check the field types against the schema.
+        walk(req.contents)
+    except ValueError as e:
+        raise ASN1ParsingError(e)
+    # Unlike load(strict=True), this tells how much was left over.
+    tail = len(data) - len(req.dump())
+    if tail:
+        raise ParsingError("%s request has %d extra bytes." %
+                           (cls.pretty_name, tail))
+    return cls.pretty_name
@@ -86,9 +86,14 @@ class KRBPriv(univ.Sequence):
     )
 
 
+# The decoder only reads the specs, so one instance of each will do.
+PROXY_MESSAGE_SPEC = ProxyMessage()
+SPECS = {cls: cls() for cls in (ASREQ, TGSREQ, APREQ, KRBPriv)}
+
+
 def decode_proxymessage(data):
     try:
-        req, tail = decoder.decode(data, asn1Spec=ProxyMessage())
+        req, tail = decoder.decode(data, asn1Spec=PROXY_MESSAGE_SPEC)
     except error.PyAsn1Error as e:
         raise ASN1ParsingError(e)
     if tail:
@@ -96,10 +101,7 @@ def decode_proxymessage(data):
     message = req.getComponentByName('message').asOctets()
     realm = req.getComponentByName('realm')
     if realm.hasValue():
-        try:  # Python 3.x
-            realm = str(realm, "utf-8")
-        except TypeError:  # Python 2.x
-            realm = str(realm)
+        realm = str(realm)
     else:
         realm = None
     flags = req.getComponentByName('flags')
@@ -115,7 +117,7 @@ def encode_proxymessage(data):
 
 def try_decode(data, cls):
     try:
-        req, tail = decoder.decode(data, asn1Spec=cls())
+        req, tail = decoder.decode(data, asn1Spec=SPECS[cls])
     except error.PyAsn1Error as e:
         raise ASN1ParsingError(e)
     if tail:
@@ -29,7 +29,8 @@ install_requires = [
 ]
 
 extras_require = {
-    "tests": ["pytest", "WebTest"],
+    "asn1crypto": ["asn1crypto"],
+    "tests": ["pytest", "WebTest", "asn1crypto"],
     "test_pep8": ['flake8', 'flake8-import-order', 'pep8-naming']
 }
 
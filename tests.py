@@ -19,9 +19,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
 import os
+import socket
+import tempfile
+import threading
 import unittest
-from base64 import b64decode
+from binascii import a2b_base64
 try:
     from unittest import mock
 except ImportError:  # pragma: no cover
@@ -41,12 +45,17 @@ except ImportError:
 import kdcproxy
 from kdcproxy import codec
 from kdcproxy import config
+from kdcproxy import parse_pyasn1
 from kdcproxy.config import mit
 
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 KRB5_CONFIG = os.path.join(HERE, 'tests.krb5.conf')
 
+# What the mocked KDCs answer, and how the proxy wraps it for the client.
+REPLY = b'RESPONSE'
+PROXY_REPLY = b'0\x0c\xa0\n\x04\x08' + REPLY
+
 
 @unittest.skipIf(WebTestApp == "skip", "webtest not installed")
 class KDCProxyWSGITests(unittest.TestCase):
@@ -56,13 +65,22 @@ class KDCProxyWSGITests(unittest.TestCase):
         (2, 3, 0, '', ('128.66.0.2', 88))
     ]
 
+    @classmethod
+    def setUpClass(cls):  # noqa
+        cls.app = kdcproxy.Application()
+        cls.tapp = WebTestApp(cls.app)
+
     def setUp(self):  # noqa
-        self.app = kdcproxy.Application()
+        # The application is shared, so start each test with empty caches
+        # and fresh mocks.
+        self.app._Application__addrinfo_cache.clear()
+        self.app._Application__lookup_cache.clear()
+        self.app._Application__pool.clear()
         self.await_reply = self.app._Application__await_reply = mock.Mock()
-        self.await_reply.return_value = b'RESPONSE'
+        self.await_reply.return_value = REPLY
         self.resolver = self.app._Application__resolver = mock.Mock()
         self.resolver.lookup.return_value = ["kerberos://k1.kdcproxy.test.:88"]
-        self.tapp = WebTestApp(self.app)
+        self.handle_recv = self.app._Application__handle_recv
 
     def post(self, body, expect_errors=False):
         return self.tapp.post(
@@ -73,7 +91,7 @@ class KDCProxyWSGITests(unittest.TestCase):
     def assert_response(self, response):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content_type, 'application/kerberos')
-        self.assertEqual(response.body, b'0\x0c\xa0\n\x04\x08RESPONSE')
+        self.assertEqual(response.body, PROXY_REPLY)
 
     def test_get(self):
         r = self.tapp.get('/', expect_errors=True)
@@ -89,7 +107,7 @@ class KDCProxyWSGITests(unittest.TestCase):
         self.resolver.lookup.assert_called_once_with('FREEIPA.LOCAL',
                                                      kpasswd=False)
         m_getaddrinfo.assert_called_once_with('k1.kdcproxy.test.', 88)
-        m_socket.assert_called_once_with(2, 1, 6)
+        m_socket.assert_called_once_with(2, 1 | kdcproxy.SOCK_NONBLOCK, 6)
         m_socket.return_value.connect.assert_called_once_with(
             ('128.66.0.2', 88)
         )
@@ -102,44 +120,240 @@ class KDCProxyWSGITests(unittest.TestCase):
         self.resolver.lookup.assert_called_once_with('FREEIPA.LOCAL',
                                                      kpasswd=True)
         m_getaddrinfo.assert_called_once_with('k1.kdcproxy.test.', 88)
-        m_socket.assert_called_once_with(2, 1, 6)
+        m_socket.assert_called_once_with(2, 1 | kdcproxy.SOCK_NONBLOCK, 6)
         m_socket.return_value.connect.assert_called_once_with(
             ('128.66.0.2', 88)
         )
 
-    def test_no_server(self):
-        self.resolver.lookup.reset_mock()
-        self.resolver.lookup.return_value = []
-        response = self.post(KDCProxyCodecTests.asreq1, True)
+    @mock.patch('socket.getaddrinfo', return_value=addrinfo)
+    @mock.patch('socket.socket')
+    def test_post_asreq_tcp_only(self, m_socket, m_getaddrinfo):
+        self.resolver.lookup.return_value = [
+            "kerberos+tcp://k1.kdcproxy.test.:88"
+        ]
+        response = self.post(KDCProxyCodecTests.asreq1)
+        self.assert_response(response)
+        m_getaddrinfo.assert_called_once_with('k1.kdcproxy.test.', 88, 0,
+                                              socket.SOCK_STREAM)
+        m_socket.assert_called_once_with(2, 1 | kdcproxy.SOCK_NONBLOCK, 6)
+        m_socket.return_value.setsockopt.assert_called_once_with(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+
+    @mock.patch('socket.getaddrinfo', return_value=addrinfo)
+    @mock.patch('socket.socket')
+    def test_post_kpasswd_default_port(self, m_socket, m_getaddrinfo):
+        self.resolver.lookup.return_value = ["kpasswd://adm.kdcproxy.test."]
+        self.app.ADDRINFO_CACHE_SIZE = 1
+        self.addCleanup(delattr, self.app, 'ADDRINFO_CACHE_SIZE')
+        response = self.post(KDCProxyCodecTests.kpasswdreq)
+        self.assert_response(response)
+        m_getaddrinfo.assert_called_once_with('adm.kdcproxy.test.', 464)
+        self.resolver.lookup.return_value = ["kpasswd://adm2.kdcproxy.test."]
+        self.app._Application__lookup_cache.clear()
+        self.assert_response(self.post(KDCProxyCodecTests.kpasswdreq))
+        self.assertEqual(list(self.app._Application__addrinfo_cache),
+                         [('adm2.kdcproxy.test.', 464, 0)])
+
+    @mock.patch('socket.getaddrinfo', return_value=addrinfo)
+    @mock.patch('socket.socket')
+    def test_addrinfo_cached(self, m_socket, m_getaddrinfo):
+        self.assert_response(self.post(KDCProxyCodecTests.asreq1))
+        self.assert_response(self.post(KDCProxyCodecTests.asreq1))
+        m_getaddrinfo.assert_called_once_with('k1.kdcproxy.test.', 88)
         self.resolver.lookup.assert_called_once_with('FREEIPA.LOCAL',
                                                      kpasswd=False)
-        self.assertEqual(response.status_code, 503)
+        self.assertEqual(m_socket.call_count, 2)
 
-        self.resolver.lookup.reset_mock()
-        self.resolver.lookup.return_value = []
-        response = self.post(KDCProxyCodecTests.kpasswdreq, True)
+    def test_lookup_cache_bounded(self):
+        self.app.LOOKUP_CACHE_SIZE = 2
+        self.addCleanup(delattr, self.app, 'LOOKUP_CACHE_SIZE')
+        lookup = self.app._Application__lookup
+        for realm in ('A.TEST', 'B.TEST', 'C.TEST'):
+            lookup(realm, False)
+        self.assertEqual(list(self.app._Application__lookup_cache),
+                         [('B.TEST', False), ('C.TEST', False)])
+
+    @mock.patch('socket.getaddrinfo', return_value=addrinfo)
+    def test_asgi_post_asreq(self, m_getaddrinfo):
+        body = KDCProxyCodecTests.asreq1
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "headers": [(b"content-length", str(len(body)).encode())],
+        }
+        messages = [
+            {"type": "http.request", "body": body[:10], "more_body": True},
+            {"type": "http.request", "body": body[10:]},
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            # Only patch socket once the event loop has its own sockets.
+            with mock.patch('socket.socket'):
+                await self.app.asgi(scope, receive, send)
+
+        asyncio.run(run())
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn((b"content-type", b"application/kerberos"),
+                      sent[0]["headers"])
+        self.assertEqual(sent[1]["body"], PROXY_REPLY)
         self.resolver.lookup.assert_called_once_with('FREEIPA.LOCAL',
-                                                     kpasswd=True)
-        self.assertEqual(response.status_code, 503)
+                                                     kpasswd=False)
 
+    @mock.patch('socket.getaddrinfo', return_value=addrinfo)
+    @mock.patch('socket.socket')
+    def test_unavailable_not_cached(self, m_socket, m_getaddrinfo):
+        self.await_reply.return_value = None
+        response = self.post(KDCProxyCodecTests.asreq1, True)
+        self.assertEqual(response.status_code, 503)
+        response = self.post(KDCProxyCodecTests.asreq1, True)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.resolver.lookup.call_count, 2)
+
+    def test_read_body_short_reads(self):
+        stream = mock.Mock()
+        stream.read.side_effect = [b'abc', b'de', b'f', b'']
+        body = self.app._Application__read_body(stream, 8)
+        self.assertEqual(body, b'abcdef')
+        self.assertEqual(stream.read.call_args_list,
+                         [mock.call(8), mock.call(5), mock.call(3),
+                          mock.call(2)])
+
+    def mksock(self, *parts):
+        parts = iter(parts)
+
+        def recv_into(buf):
+            part = next(parts)
+            buf[:len(part)] = part
+            return len(part)
+
+        sock = mock.Mock()
+        sock.recv_into = recv_into
+        return sock
+
+    def test_udp_message(self):
+        sock = self.mksock(b'RESPONSE')
+        reply = self.handle_recv(sock, socket.SOCK_DGRAM, {})
+        self.assertEqual(reply, (8).to_bytes(4, "big") + b'RESPONSE')
+
+    def test_tcp_message(self):
+        msg = (8).to_bytes(4, "big") + b'RESPONSE'
+        sock = self.mksock(msg[:2], msg[2:4], msg[4:9], msg[9:])
+        read_buffers = {}
+        for _ in range(3):
+            self.assertIsNone(self.handle_recv(
+                sock, socket.SOCK_STREAM, read_buffers
+            ))
+        reply = self.handle_recv(sock, socket.SOCK_STREAM, read_buffers)
+        self.assertEqual(reply, msg)
+        self.assertEqual(read_buffers, {})
+
+    def test_tcp_message_length_exceeds_max(self):
+        max_len = self.app.MAX_REPLY_LENGTH
+        sock = self.mksock((max_len + 1).to_bytes(4, "big"))
+        read_buffers = {}
+        with self.assertRaises(ValueError):
+            self.handle_recv(sock, socket.SOCK_STREAM, read_buffers)
+        self.assertEqual(read_buffers, {})
+
+    def test_tcp_eof_returns_buffered_data(self):
+        sock = self.mksock((8).to_bytes(4, "big"), b'RESP', b'')
+        read_buffers = {}
+        for _ in range(2):
+            self.assertIsNone(self.handle_recv(
+                sock, socket.SOCK_STREAM, read_buffers
+            ))
+        reply = self.handle_recv(sock, socket.SOCK_STREAM, read_buffers)
+        self.assertEqual(reply, (8).to_bytes(4, "big") + b'RESP')
+        self.assertEqual(read_buffers, {})
+
+    def test_tcp_eof_without_reply(self):
+        sock = self.mksock(b'')
+        read_buffers = {}
+        self.assertRaises(EOFError, self.handle_recv,
+                          sock, socket.SOCK_STREAM, read_buffers)
+        self.assertEqual(read_buffers, {})
+
+    def test_tcp_pool(self):
+        addr = (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP,
+                '', ('128.66.0.2', 88))
+        sock, peer = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        sock.setblocking(0)
+        self.assertTrue(self.app._Application__checkin(addr, sock))
+        self.assertIs(self.app._Application__checkout(addr), sock)
+        self.assertIsNone(self.app._Application__checkout(addr))
+        # Connections the KDC closed are not kept around.
+        peer.close()
+        self.assertFalse(self.app._Application__checkin(addr, sock))
+
+    def test_tcp_pool_stale(self):
+        # A KDC that answers one request per connection.
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        def serve():
+            conn, _ = server.accept()
+            with conn:
+                request = conn.recv(65536)
+                while len(request) < 4 + int.from_bytes(request[:4], "big"):
+                    request += conn.recv(65536)
+                conn.sendall((8).to_bytes(4, "big") + REPLY)
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+
+        # Hand out a pooled connection the KDC has already closed.
+        stale, peer = socket.socketpair()
+        self.addCleanup(stale.close)
+        stale.setblocking(0)
+        peer.close()
+        del self.app._Application__await_reply
+        self.resolver.lookup.return_value = [
+            "kerberos+tcp://127.0.0.1:%d" % server.getsockname()[1]
+        ]
+        with mock.patch.object(self.app, '_Application__checkout',
+                               side_effect=[stale, None]):
+            response = self.post(KDCProxyCodecTests.asreq1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body,
+                         codec.encode((8).to_bytes(4, "big") + REPLY))
 
-def decode(data):
-    data = data.replace(b'\\n', b'')
-    data = data.replace(b' ', b'')
-    return b64decode(data)
+    def test_no_server(self):
+        self.resolver.lookup.return_value = []
+        for body, kpasswd in ((KDCProxyCodecTests.asreq1, False),
+                              (KDCProxyCodecTests.kpasswdreq, True)):
+            with self.subTest(kpasswd=kpasswd):
+                self.resolver.lookup.reset_mock()
+                response = self.post(body, True)
+                self.resolver.lookup.assert_called_once_with(
+                    'FREEIPA.LOCAL', kpasswd=kpasswd
+                )
+                self.assertEqual(response.status_code, 503)
 
 
 class KDCProxyCodecTests(unittest.TestCase):
     realm = 'FREEIPA.LOCAL'
 
-    asreq1 = decode(b"""
+    asreq1 = a2b_base64(b"""
         MIHEoIGwBIGtAAAAqWqBpjCBo6EDAgEFogMCAQqjDjAMMAqhBAICAJWiAgQApIGGMIGDo
         AcDBQBAAAAQoRIwEKADAgEBoQkwBxsFYWRtaW6iDxsNRlJFRUlQQS5MT0NBTKMiMCCgAw
         IBAqEZMBcbBmtyYnRndBsNRlJFRUlQQS5MT0NBTKURGA8yMDE1MDUxNDEwNDIzOFqnBgI
         EEchjtagUMBICARICARECARACARcCARkCARqhDxsNRlJFRUlQQS5MT0NBTA==
     """)
 
-    asreq2 = decode(b"""
+    asreq2 = a2b_base64(b"""
         MIIBJaCCARAEggEMAAABCGqCAQQwggEAoQMCAQWiAwIBCqNrMGkwDaEEAgIAhaIFBANNS
         VQwTKEDAgECokUEQzBBoAMCARKiOgQ48A25MkXWM1ZrTvaYMJcbFX7Hp7JW11omIwqOQd
         SSGKVZ9mzYLuL19RRhX9xrXbQS0klXRVgRWHMwCqEEAgIAlaICBACkgYYwgYOgBwMFAEA
@@ -148,7 +362,7 @@ class KDCProxyCodecTests(unittest.TestCase):
         BQwEgIBEgIBEQIBEAIBFwIBGQIBGqEPGw1GUkVFSVBBLkxPQ0FM
     """)
 
-    tgsreq = decode(b"""
+    tgsreq = a2b_base64(b"""
         MIIDxaCCA7AEggOsAAADqGyCA6QwggOgoQMCAQWiAwIBDKOCAxowggMWMIICL6EDAgEBo
         oICJgSCAiJuggIeMIICGqADAgEFoQMCAQ6iBwMFAAAAAACjggFGYYIBQjCCAT6gAwIBBa
         EPGw1GUkVFSVBBLkxPQ0FMoiIwIKADAgECoRkwFxsGa3JidGd0Gw1GUkVFSVBBLkxPQ0F
@@ -170,7 +384,7 @@ class KDCProxyCodecTests(unittest.TestCase):
         QwEgIBEgIBEQIBEAIBFwIBGQIBGqEPGw1GUkVFSVBBLkxPQ0FM
     """)
 
-    kpasswdreq = decode(b"""
+    kpasswdreq = a2b_base64(b"""
         MIICeKCCAmMEggJfAAACWwJbAAECAm6CAf4wggH6oAMCAQWhAwIBDqIHAwUAAAAAAKOCA
         UFhggE9MIIBOaADAgEFoQ8bDUZSRUVJUEEuTE9DQUyiHTAboAMCAQGhFDASGwZrYWRtaW
         4bCGNoYW5nZXB3o4IBADCB/aADAgESoQMCAQGigfAEge3swqU5Z7QS15Hf8+o9UPdl3H7
@@ -217,6 +431,17 @@ class KDCProxyCodecTests(unittest.TestCase):
         outer = self.assert_decode(self.tgsreq, codec.TGSProxyRequest)
         self.assertEqual(str(outer), 'FREEIPA.LOCAL TGS-REQ (936 bytes)')
 
+    def test_malformed_asreq_decoded_once(self):
+        request = codec.UINT32.pack(5) + bytes.fromhex('6a03300100')
+        data = codec.asn1mod.encode_proxymessage(request)
+        with mock.patch.object(
+            codec.ASProxyRequest, 'parse_request',
+            wraps=codec.ASProxyRequest.parse_request
+        ) as m_parse:
+            self.assertRaises(codec.ParsingError,
+                              codec.ProxyRequest.parse, data)
+        m_parse.assert_called_once()
+
     def test_kpasswdreq(self):
         outer = self.assert_decode(self.kpasswdreq,
                                    codec.KPASSWDProxyRequest)
@@ -225,12 +450,86 @@ class KDCProxyCodecTests(unittest.TestCase):
             'FREEIPA.LOCAL KPASSWD-REQ (603 bytes) (version 0x0001)'
         )
 
+    def test_encode(self):
+        self.assertEqual(codec.encode(REPLY), PROXY_REPLY)
+        self.assertEqual(codec.encode(bytearray(REPLY)), PROXY_REPLY)
+        for size in (8, 1024, 65536):
+            with self.subTest(size=size):
+                reply = b'X' * size
+                der = codec.encode(reply)
+                message, realm, flags = codec.asn1mod.decode_proxymessage(der)
+                self.assertEqual(message, reply)
+                self.assertIsNone(realm)
+                self.assertIsNone(flags)
+
+    def test_asn1_backends(self):
+        # codec picks one backend, make sure both behave the same.
+        backends = [parse_pyasn1]
+        try:
+            from kdcproxy import parse_asn1crypto
+        except ImportError:  # pragma: no cover
+            pass
+        else:
+            backends.append(parse_asn1crypto)
+        malformed = bytes.fromhex('6a03300100')
+        nested = b''
+        for _ in range(3000):
+            nested = b'\x30\x82' + codec.UINT16.pack(len(nested)) + nested
+        nested = b'\x6a\x82' + codec.UINT16.pack(len(nested)) + nested
+        for mod in backends:
+            with self.subTest(backend=mod.__name__):
+                request, realm, flags = mod.decode_proxymessage(self.asreq1)
+                self.assertEqual(realm, self.realm)
+                self.assertIsNone(flags)
+                self.assertEqual(mod.try_decode(request[4:], mod.ASREQ),
+                                 'AS-REQ')
+                self.assertRaises(codec.ParsingError, mod.try_decode,
+                                  request[4:], mod.TGSREQ)
+                self.assertRaises(codec.ParsingError, mod.try_decode,
+                                  request[4:] + b'\0', mod.ASREQ)
+                self.assertRaises(codec.ParsingError, mod.try_decode,
+                                  malformed, mod.ASREQ)
+                self.assertRaises(codec.ParsingError, mod.try_decode,
+                                  nested, mod.ASREQ)
+                self.assertEqual(mod.encode_proxymessage(bytearray(REPLY)),
+                                 PROXY_REPLY)
+
+    def test_decode_cached(self):
+        outer = codec.decode(self.asreq1)
+        self.assertIs(codec.decode(self.asreq1), outer)
+        # A parsing failure is raised again rather than remembered.
+        for _ in range(2):
+            self.assertRaises(codec.ParsingError, codec.decode, b"garbage")
+
 
 class KDCProxyConfigTests(unittest.TestCase):
 
+    def test_kdcproxy_config_parsed_once(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.conf') as f:
+            f.write("[KDCPROXY.TEST]\nkerberos = kerberos://k1.test:88\n")
+            f.flush()
+            cfg1 = config.KDCProxyConfig(f.name)
+            cfg2 = config.KDCProxyConfig(f.name)
+            self.assertIs(cfg1._KDCProxyConfig__cp, cfg2._KDCProxyConfig__cp)
+            self.assertEqual(list(cfg2.lookup('KDCPROXY.TEST')),
+                             ['kerberos://k1.test:88'])
+            self.assertEqual(cfg2.lookup('KDCPROXY.TEST', True), ())
+            self.assertEqual(cfg2.lookup('KDCPROXY.MISSING'), ())
+
+            f.write("kpasswd = kpasswd://k1.test\n")
+            f.flush()
+            st = os.stat(f.name)
+            os.utime(f.name, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            cfg3 = config.KDCProxyConfig(f.name)
+            self.assertEqual(list(cfg3.lookup('KDCPROXY.TEST', True)),
+                             ['kpasswd://k1.test'])
+
     def test_mit_config(self):
         with mock.patch.dict('os.environ', {'KRB5_CONFIG': KRB5_CONFIG}):
             cfg = mit.MITConfig()
+            # The parsed profile is shared while krb5.conf is unchanged.
+            self.assertIs(mit.MITConfig()._MITConfig__config,
+                          cfg._MITConfig__config)
 
         self.assertIs(cfg.use_dns(), False)
         self.assertEqual(
@@ -255,6 +554,24 @@ class KDCProxyConfigTests(unittest.TestCase):
         self.assertEqual(cfg.lookup('KDCPROXY.MISSING'), ())
         self.assertEqual(cfg.lookup('KDCPROXY.MISSING', True), ())
 
+    def test_krb5profile_closed(self):
+        with mock.patch.dict('os.environ', {'KRB5_CONFIG': KRB5_CONFIG}):
+            with mit.KRB5Profile() as prof:
+                self.assertTrue(prof.section('realms'))
+        # The released profile must not be handed to libkrb5 again.
+        self.assertRaises(mit.KRB5Error, prof.section, 'realms')
+
+    def test_parse_kdc_url(self):
+        parse = kdcproxy.parse_kdc_url
+        self.assertEqual(parse('kerberos://k1.kdcproxy.test.:88'),
+                         ('kerberos', 'k1.kdcproxy.test.', 88))
+        self.assertEqual(parse('kpasswd+tcp://Adm.KDCProxy.test.'),
+                         ('kpasswd+tcp', 'adm.kdcproxy.test.', None))
+        self.assertEqual(parse('kerberos+udp://[2001:db8::2]:1088/'),
+                         ('kerberos+udp', '2001:db8::2', 1088))
+        self.assertEqual(parse('kerberos://[2001:db8::2]'),
+                         ('kerberos', '2001:db8::2', None))
+
     def mksrv(self, txt):
         priority, weight, port, target = txt.split(' ')
         return SRV(
@@ -266,19 +583,30 @@ class KDCProxyConfigTests(unittest.TestCase):
             target=target
         )
 
-    @mock.patch('dns.resolver.query')
-    def test_dns_config(self, m_query):
+    def mkanswer(self, *records):
+        answer = mock.MagicMock()
+        answer.__iter__.side_effect = lambda: iter(records)
+        answer.rrset.ttl = 300
+        return answer
+
+    @mock.patch('dns.resolver.Resolver')
+    def test_dns_config(self, m_resolver):
+        m_query = m_resolver.return_value.resolve
         cfg = config.DNSResolver()
-        tcp = [
+        tcp = self.mkanswer(
             self.mksrv('30 100 88 k1_tcp.kdcproxy.test.'),
             self.mksrv('10 100 1088 k2_tcp.kdcproxy.test.'),
-        ]
-        udp = [
+        )
+        udp = self.mkanswer(
             self.mksrv('0 100 88 k1_udp.kdcproxy.test.'),
             self.mksrv('10 100 1088 k2_udp.kdcproxy.test.'),
             self.mksrv('0 100 88 k3_udp.kdcproxy.test.'),
-        ]
-        m_query.side_effect = [tcp, udp]
+        )
+        answers = {
+            '_kerberos._tcp.KDCPROXY.TEST': tcp,
+            '_kerberos._udp.KDCPROXY.TEST': udp,
+        }
+        m_query.side_effect = lambda query, rdtype: answers.get(query, [])
 
         self.assertEqual(
             tuple(cfg.lookup('KDCPROXY.TEST')),
@@ -294,12 +622,19 @@ class KDCProxyConfigTests(unittest.TestCase):
         m_query.assert_any_call('_kerberos._tcp.KDCPROXY.TEST', RDTYPE_SRV)
         m_query.assert_any_call('_kerberos._udp.KDCPROXY.TEST', RDTYPE_SRV)
 
+        # Answers are cached for the TTL of the records.
         m_query.reset_mock()
-        adm = [
+        self.assertEqual(len(tuple(cfg.lookup('KDCPROXY.TEST'))), 5)
+        m_query.assert_not_called()
+        self.assertEqual(tuple(cfg.lookup('KDCPROXY.MISSING')), ())
+        self.assertEqual(tuple(cfg.lookup('KDCPROXY.MISSING')), ())
+        self.assertEqual(m_query.call_count, 2)
+
+        adm = self.mkanswer(
             self.mksrv('0 0 749 adm.kdcproxy.test.'),
-        ]
-        empty = []
-        m_query.side_effect = (empty, adm, empty, empty)
+        )
+        answers = {'_kerberos-adm._tcp.KDCPROXY.TEST': adm}
+        m_query.reset_mock()
         self.assertEqual(
             tuple(cfg.lookup('KDCPROXY.TEST', kpasswd=True)),
             (